@@ -1,16 +1,40 @@
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
 import functools
-import json
+import inspect
+import itertools
+import logging
+import os
 import pathlib
+import sqlite3
+import threading
 import typing
 
+import ahocorasick
 import click
 import fastapi
-from ollama import Client
+from fastapi.responses import StreamingResponse
+import orjson
+from ollama import AsyncClient, ChatResponse
 from multilspy import SyncLanguageServer
+from multilspy.lsp_protocol_handler.server import Error as LspError
 from multilspy.multilspy_config import MultilspyConfig
+from multilspy.multilspy_exceptions import MultilspyException
 from multilspy.multilspy_logger import MultilspyLogger
 import pydantic
 
+try:
+    # Several times faster than SHA-256 where it's installed
+    from blake3 import blake3 as content_hash
+except ImportError:
+    from hashlib import sha256 as content_hash
+
+
+log = logging.getLogger(__name__)
+
 
 PROMPT = """
 You are an expert code manipulation tool.
@@ -20,8 +44,9 @@ provided a set of tools for auditing and manipulating this project. You must use
 provided to the best of your ability to answer rthe user's questions precisely and in a
 concise, accurate manner.
 
-You will also be provided with a list of filenames in the project, which may give you
-additional insight into the structure of the project's code repository.
+You will also be provided with a summary of the top-level files and directories in the
+project, which may give you additional insight into the structure of the project's code
+repository. Use `list_files_in_repository` if you need the full list of filenames.
 
 You may _only_ use code that has been presented to you, either via a prompt or as a
 tool call from `get_file_source`. Please use `get_file_source` as your source for truth for
@@ -32,37 +57,291 @@ tool calls to further dig into the problem.
 """
 
 
+# Only files the search/LSP tools can do something useful with are listed.
+TEXT_EXTENSIONS = {
+    ".c", ".cfg", ".cpp", ".css", ".go", ".h", ".hpp", ".html", ".ini", ".java",
+    ".js", ".json", ".jsx", ".md", ".py", ".pyi", ".rb", ".rs", ".rst", ".sh",
+    ".toml", ".ts", ".tsx", ".txt", ".yaml", ".yml",
+}  # fmt: skip
+NOISE_DIRECTORIES = {"__pycache__", "node_modules", ".venv", "venv", "dist", "build"}
+MAX_FILE_BYTES = 1 << 20
+
+# File reads and LSP round trips block outside the GIL, so the repository-wide tools
+# fan out over a shared thread pool. SyncLanguageServer isn't documented as reentrant,
+# so only a few requests are allowed in flight against it at once.
+TOOL_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=min(32, (os.cpu_count() or 1) * 4)
+)
+LSP_CONCURRENCY = threading.BoundedSemaphore(4)
+
+# What reading or analyzing one bad file can raise; the repository-wide tools skip it.
+FILE_ERRORS = (
+    OSError,
+    UnicodeDecodeError,
+    sqlite3.Error,
+    MultilspyException,
+    LspError,
+)
+
+# Document symbols are kept between runs in the repository being analyzed.
+SYMBOL_CACHE_FILE_NAME = ".rag_cache.sqlite"
+SYMBOL_CACHE_VERSION = 2
+
+
+# Tool results are re-tokenized by the model on every turn, so keep them small.
+MAX_TOOL_RESULT_ITEMS = 200
+MAX_TOOL_RESULT_BYTES = 32_000
+TRUNCATED_TOOL_RESULT_PREVIEW_ITEMS = 10
+SYMBOL_KEYS_TO_STRIP = {"range", "selectionRange", "location"}
+# Stop calling tools once the transcript gets near the model's context window.
+MAX_TRANSCRIPT_CHARACTERS = 120_000
+# Questions answered in one chat; latency grows faster than linearly past this.
+MAX_BATCH_SIZE = 8
+
+
 SymbolLocation = typing.TypedDict(
     "SymbolLocation", {"file_path": str, "row": int, "column": int}
 )
+PatternLocation = typing.TypedDict(
+    "PatternLocation",
+    {"file_path": str, "row": int, "column": int, "string_pattern": str},
+)
+
+
+def _find_offsets(
+    haystack: typing.AnyStr, needle: typing.AnyStr
+) -> typing.Iterator[int]:
+    """Yields the offset of every non-overlapping occurrence of needle in haystack."""
+    position = haystack.find(needle)
+    while position >= 0:
+        yield position
+        position = haystack.find(needle, position + len(needle))
+
+
+LoadedFile = typing.NamedTuple(
+    "LoadedFile",
+    [
+        ("text", str),
+        ("lowered", str),
+        ("line_starts", list[int]),
+        ("lowered_bytes", bytes),
+        ("byte_line_starts", list[int]),
+        ("text_line_starts", list[int]),
+    ],
+)
+
+
+def _line_starts(buffer: typing.AnyStr) -> list[int]:
+    """Returns the offset each line of buffer starts at."""
+    newline = "\n" if isinstance(buffer, str) else b"\n"
+    return [0, *(position + 1 for position in _find_offsets(buffer, newline))]
+
+
+@functools.lru_cache(maxsize=256)
+def _load_file(abs_path: pathlib.Path, mtime_ns: int) -> LoadedFile:
+    """Reads a file once per modification time, along with lowercased copies for
+    case-insensitive search and the offset each line starts at."""
+    data = abs_path.read_bytes()
+    text = data.decode("utf-8", "replace")
+    lowered = text.lower()
+    line_starts = _line_starts(lowered)
+
+    return LoadedFile(
+        text=text,
+        lowered=lowered,
+        line_starts=line_starts,
+        # bytes.lower() only touches ASCII, but that's all an ASCII pattern can match
+        lowered_bytes=data.lower(),
+        byte_line_starts=_line_starts(data),
+        # Lowercasing only ever lengthens characters ('İ' becomes two), so if the
+        # lengths agree, so do all the offsets
+        text_line_starts=(
+            line_starts if len(lowered) == len(text) else _line_starts(text)
+        ),
+    )
+
+
+def _row_and_column(loaded: LoadedFile, position: int) -> tuple[int, int]:
+    """Converts an offset into a file's lowered text to a 1-based (row, column) pair in
+    its original text."""
+    row = bisect.bisect_right(loaded.line_starts, position)
+    column_offset = position - loaded.line_starts[row - 1]
+
+    if loaded.text_line_starts is not loaded.line_starts:
+        # Walk the original line, counting how far each character moves the lowered one
+        lowered_length = 0
+        original_offset = 0
+        for character in loaded.text[loaded.text_line_starts[row - 1] :]:
+            if lowered_length >= column_offset:
+                break
+            lowered_length += len(character.lower())
+            original_offset += 1
+        column_offset = original_offset
+
+    return row, column_offset + 1
+
+
+def _load_file_if_small(abs_path: pathlib.Path) -> LoadedFile | None:
+    """Loads a file through the _load_file cache, unless it's over MAX_FILE_BYTES; a big
+    log or data file would otherwise be held in memory several times over."""
+    stat = abs_path.stat()
+    if stat.st_size > MAX_FILE_BYTES:
+        return None
+    return _load_file(abs_path, stat.st_mtime_ns)
+
+
+def _report_skipped_files(skipped_files: collections.Counter):
+    """Prints how many files a query skipped and why. A steady stream of the same error
+    usually means a slow fallback path is being taken."""
+    if skipped_files:
+        print(f"Skipped files: {dict(skipped_files)}")
+
+
+def open_symbol_cache(local_path: pathlib.Path) -> sqlite3.Connection:
+    """Opens (creating if need be) the on-disk document symbol cache for a repository.
+    Rows are keyed by file path and valid for the mtime they were stored with; the
+    content hash lets a file whose mtime changed but whose contents didn't, or a copy
+    of it elsewhere in the tree, reuse them too."""
+    connection = sqlite3.connect(
+        local_path / SYMBOL_CACHE_FILE_NAME, check_same_thread=False
+    )
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    if connection.execute("PRAGMA user_version").fetchone()[0] != SYMBOL_CACHE_VERSION:
+        # It's only a cache; start over rather than migrate
+        connection.execute("DROP TABLE IF EXISTS symbols")
+        connection.execute(f"PRAGMA user_version = {SYMBOL_CACHE_VERSION}")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS symbols"
+        " (path TEXT PRIMARY KEY, mtime INTEGER, hash TEXT, json BLOB)"
+    )
+    connection.execute("CREATE INDEX IF NOT EXISTS symbols_hash ON symbols (hash)")
+    return connection
+
+
+def _normalize_tool_arguments(arguments: dict) -> dict:
+    """Normalizes `file_path` and `string_pattern` arguments so e.g. "foo.py" and
+    "./foo.py" share a cache entry. Searches are case-insensitive, so the pattern is
+    lowercased."""
+    normalized = dict(arguments)
+    if normalized.get("file_path"):
+        normalized["file_path"] = os.path.normpath(normalized["file_path"])
+    if normalized.get("string_pattern"):
+        normalized["string_pattern"] = normalized["string_pattern"].lower()
+    for name, value in normalized.items():
+        # The model sends JSON arrays, which lru_cache can't hash
+        if isinstance(value, list):
+            normalized[name] = tuple(value)
+    return normalized
+
+
+def cached(maxsize: int = 512):
+    """functools.lru_cache, except the arguments go through _normalize_tool_arguments
+    first. The lru_cache is always called positionally, and is exposed as
+    `cached_function` so specialize_tool can call it without binding the signature."""
+
+    def decorator(f):
+        signature = inspect.signature(f)
+        cached_f = functools.lru_cache(maxsize=maxsize)(f)
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return cached_f(*_normalize_tool_arguments(bound.arguments).values())
+
+        wrapper.cache_clear = cached_f.cache_clear
+        wrapper.cache_info = cached_f.cache_info
+        wrapper.cached_function = cached_f
+        return wrapper
+
+    return decorator
 
 
 # Functions to send to llama, so it can call them.
 def compute_tools_for_context(
-    local_path: pathlib.Path, lsp: SyncLanguageServer
+    local_path: pathlib.Path,
+    lsp: SyncLanguageServer,
+    symbol_cache: sqlite3.Connection,
+    skipped_files: collections.Counter | None = None,
 ) -> dict[str, callable]:
     """The functions in e.g. the lsp's docstrings are broken, so we're sending a wrapped
     'bare' version to the tool calls so it gets the parameter names right.
+
+    Files the tools couldn't read are counted by error type in `skipped_files`.
     """
+    if skipped_files is None:
+        skipped_files = collections.Counter()
+
+    # Files get skipped from the thread pool
+    skipped_files_lock = threading.Lock()
+
+    def skip_file(file_path: str, error: Exception):
+        log.debug("skipped %s: %s", file_path, error)
+        with skipped_files_lock:
+            skipped_files[type(error).__name__] += 1
+
+    # Directory mtimes from the last walk; a file being added, removed or renamed
+    # bumps its parent directory's mtime, so the listing only needs a re-walk then.
+    # Tools run concurrently, so the check-and-walk happens under a lock and each walk
+    # builds a fresh list rather than touching one a caller may still be reading.
+    directory_mtimes: dict[str, int] = {}
+    file_list: list[str] = []
+    file_list_lock = threading.Lock()
 
     def list_files_in_repository() -> list[str]:
         """Returns a list of all the files in the code repository"""
-        file_list = []
-        for path, dirs, files in local_path.walk(follow_symlinks=False):
-            if path.name.startswith("."):
-                # Ignore dot dirs -- don't winnow down
-                dirs.clear()
-                continue
+        with file_list_lock:
+            return walk_repository_if_changed()
 
-            for file in files:
-                relative_file_name = ((local_path / path) / file).relative_to(
-                    local_path
-                )
-                if path.name.startswith("."):
-                    continue
+    def walk_repository_if_changed() -> list[str]:
+        nonlocal directory_mtimes, file_list
 
-                file_list.append(str(relative_file_name))
+        try:
+            if directory_mtimes and all(
+                os.stat(path).st_mtime_ns == mtime
+                for path, mtime in directory_mtimes.items()
+            ):
+                return file_list
+        except OSError:
+            pass
 
+        root = str(local_path)
+        new_directory_mtimes = {}
+        new_file_list = []
+        pending = collections.deque([root])
+        while pending:
+            directory = pending.pop()
+            try:
+                new_directory_mtimes[directory] = os.stat(directory).st_mtime_ns
+                entries = os.scandir(directory)
+            except OSError:
+                continue
+
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        # Ignore dot dirs -- don't winnow down
+                        if not (
+                            entry.name.startswith(".")
+                            or entry.name in NOISE_DIRECTORIES
+                        ):
+                            pending.append(entry.path)
+                        continue
+
+                    if os.path.splitext(entry.name)[1].lower() not in TEXT_EXTENSIONS:
+                        continue
+                    try:
+                        # DirEntry caches the stat, and it's a no-op for most entries
+                        if not entry.is_file() or entry.stat().st_size > MAX_FILE_BYTES:
+                            continue
+                    except OSError:
+                        # Dangling symlinks and the like
+                        continue
+
+                    new_file_list.append(entry.path[len(root) + 1 :])
+
+        directory_mtimes, file_list = new_directory_mtimes, new_file_list
         return file_list
 
     def find_string_in_file(
@@ -74,58 +353,205 @@ def compute_tools_for_context(
             return patterns
 
         abs_path = local_path / file_path
-        if abs_path.is_relative_to(local_path):
-            with open(str(abs_path), "r") as in_handle:
-                for line_number, line in enumerate(in_handle):
-                    if string_pattern.lower() in line.lower():
-                        patterns.append(
-                            {
-                                "file_path": file_path,
-                                "row": line_number + 1,
-                                "column": line.index(string_pattern) + 1,
-                            }
-                        )
-
-        return tuple(patterns)
+        if string_pattern and abs_path.is_relative_to(local_path):
+            loaded = _load_file_if_small(abs_path)
+            if loaded is None:
+                return patterns
+
+            if string_pattern.isascii():
+                # The common case: scan the bytes directly, no Unicode case mapping
+                for position in _find_offsets(
+                    loaded.lowered_bytes, string_pattern.lower().encode("utf-8")
+                ):
+                    row = bisect.bisect_right(loaded.byte_line_starts, position)
+                    line_prefix = loaded.lowered_bytes[
+                        loaded.byte_line_starts[row - 1] : position
+                    ]
+                    patterns.append(
+                        {
+                            "file_path": file_path,
+                            "row": row,
+                            "column": len(line_prefix.decode("utf-8", "replace")) + 1,
+                        }
+                    )
+            else:
+                for position in _find_offsets(loaded.lowered, string_pattern.lower()):
+                    row, column = _row_and_column(loaded, position)
+                    patterns.append(
+                        {"file_path": file_path, "row": row, "column": column}
+                    )
+
+        return patterns
+
+    def search_every_file(search_one_file: typing.Callable[[str], list]) -> list:
+        """Runs a per-file search over every file in the repository on the thread pool,
+        skipping any file that can't be read."""
+
+        def search_or_skip(file: str) -> list:
+            try:
+                return search_one_file(file)
+            except FILE_ERRORS as e:
+                skip_file(file, e)
+                return []
+
+        return list(
+            itertools.chain.from_iterable(
+                TOOL_EXECUTOR.map(search_or_skip, list_files_in_repository())
+            )
+        )
 
     def find_string_in_repository(string_pattern: str) -> list[SymbolLocation]:
         """Finds all the matching instances of a search string in the repository,
         in all files."""
-        symbols = []
-        for file in list_files_in_repository():
-            try:
-                symbols.extend(find_string_in_file(file, string_pattern))
-            except:
-                pass
+        return search_every_file(lambda file: find_string_in_file(file, string_pattern))
 
-        return tuple(symbols)
+    # The repository-wide tools hit the symbol cache from worker threads
+    symbol_cache_lock = threading.Lock()
 
     def request_document_symbols(file_path: str) -> list[dict]:
         """Gets a list of defined code symbols in a file."""
-        symbols = lsp.request_document_symbols(file_path)[0]
+        cache_key = os.path.normpath(file_path)
+        abs_path = local_path / file_path
+        mtime_ns = abs_path.stat().st_mtime_ns
+
+        with symbol_cache_lock:
+            row = symbol_cache.execute(
+                "SELECT json FROM symbols WHERE path = ? AND mtime = ?",
+                (cache_key, mtime_ns),
+            ).fetchone()
+
+        if row:
+            symbols = orjson.loads(row[0])
+        else:
+            # mtimes are unreliable (touch, checkouts, network mounts); the contents
+            # may well be ones we've already asked the LSP about
+            file_hash = content_hash(abs_path.read_bytes()).hexdigest()
+            with symbol_cache_lock:
+                row = symbol_cache.execute(
+                    "SELECT json FROM symbols WHERE hash = ? LIMIT 1", (file_hash,)
+                ).fetchone()
+
+            if row:
+                symbols_json = row[0]
+                symbols = orjson.loads(symbols_json)
+            else:
+                try:
+                    with LSP_CONCURRENCY:
+                        symbols = lsp.request_document_symbols(file_path)[0]
+                except AssertionError:
+                    # jedi-language-server answers None for a file with no symbols
+                    # (an empty __init__.py, most non-Python files), which trips
+                    # multilspy's `assert isinstance(response, list)`. Not cached: the
+                    # assertion could be something transient, and empty files are cheap
+                    # to ask about again.
+                    return []
+                symbols_json = orjson.dumps(symbols)
+
+            with symbol_cache_lock:
+                symbol_cache.execute(
+                    "INSERT OR REPLACE INTO symbols VALUES (?, ?, ?, ?)",
+                    (cache_key, mtime_ns, file_hash, symbols_json),
+                )
+                symbol_cache.commit()
+
+        # Source ranges make up most of a symbol's payload and the model has no use for
+        # them; request_references locates code by searching for it instead. Locations
+        # may also point at another file with the same contents.
         return [
-            (d | {"file_path": file_path}) if isinstance(d, dict) else d
+            (
+                {k: v for k, v in d.items() if k not in SYMBOL_KEYS_TO_STRIP}
+                | {"file_path": file_path}
+            )
+            if isinstance(d, dict)
+            else d
             for d in symbols
         ]
 
+    def find_strings_in_repository(
+        string_patterns: list[str],
+    ) -> list[PatternLocation]:
+        """Finds all the matching instances of several search strings in the repository,
+        in all files. Cheaper than searching for each string separately."""
+        if isinstance(string_patterns, str):
+            # llama3.2 often sends arrays as JSON-encoded strings; iterating one would
+            # search for every single character in it
+            try:
+                decoded = orjson.loads(string_patterns)
+            except orjson.JSONDecodeError:
+                decoded = string_patterns
+            if isinstance(decoded, list):
+                string_patterns = decoded
+            elif isinstance(decoded, str):
+                string_patterns = [decoded]
+            else:
+                string_patterns = [string_patterns]
+        if not isinstance(string_patterns, (list, tuple)) or not all(
+            isinstance(string_pattern, str) for string_pattern in string_patterns
+        ):
+            raise TypeError("string_patterns must be a list of strings")
+
+        # One Aho-Corasick automaton matches every pattern in a single pass per file
+        automaton = ahocorasick.Automaton()
+        for string_pattern in string_patterns:
+            if string_pattern:
+                needle = string_pattern.lower()
+                automaton.add_word(needle, (len(needle), string_pattern))
+        if not len(automaton):
+            return []
+        automaton.make_automaton()
+
+        def find_in_one_file(file: str) -> list[PatternLocation]:
+            abs_path = local_path / file
+            loaded = _load_file_if_small(abs_path)
+            if loaded is None:
+                return []
+
+            patterns = []
+            for end, (length, string_pattern) in automaton.iter(loaded.lowered):
+                row, column = _row_and_column(loaded, end - length + 1)
+                patterns.append(
+                    {
+                        "file_path": file,
+                        "row": row,
+                        "column": column,
+                        "string_pattern": string_pattern,
+                    }
+                )
+            return patterns
+
+        return search_every_file(find_in_one_file)
+
     def request_repository_symbols() -> list[dict]:
         """Finds all code symbols defined in a repository."""
-        symbols = []
-        for file_path in list_files_in_repository():
+        files = list_files_in_repository()
+        futures = {
+            TOOL_EXECUTOR.submit(request_document_symbols, file_path): file_path
+            for file_path in files
+        }
+
+        symbols_by_file = {}
+        for future in concurrent.futures.as_completed(futures):
             try:
-                ds = request_document_symbols(file_path)
-                symbols.extend(ds)
-            except:
-                pass
-
-        return tuple(symbols)
+                symbols_by_file[futures[future]] = future.result()
+            except FILE_ERRORS as e:
+                skip_file(futures[future], e)
+
+        # Keep the output in file order so the transcript is stable between calls
+        return list(
+            itertools.chain.from_iterable(
+                symbols_by_file[file_path]
+                for file_path in files
+                if file_path in symbols_by_file
+            )
+        )
 
     def request_references(file_path: str, code: str):
         """Find all the references for a specific piece of code in a file."""
-        return [
-            lsp.request_references(file_path, pattern["row"], pattern["column"])
-            for pattern in find_string_in_file(file_path, code)
-        ]
+        with LSP_CONCURRENCY:
+            return [
+                lsp.request_references(file_path, pattern["row"], pattern["column"])
+                for pattern in find_string_in_file(file_path, code)
+            ]
 
     def get_file_source(file_path: str) -> str:
         if not file_path:
@@ -134,20 +560,27 @@ def compute_tools_for_context(
         try:
             abs_path = local_path / file_path
             if abs_path.is_relative_to(local_path):
-                with open(abs_path, "r") as in_handle:
-                    return f"The contents of {file_path} are as following:\n```\n{in_handle.read()}\n```"
-        except:
-            pass
+                loaded = _load_file_if_small(abs_path)
+                if loaded is not None:
+                    return f"The contents of {file_path} are as following:\n```\n{loaded.text}\n```"
+        except FILE_ERRORS as e:
+            skip_file(file_path, e)
 
         return f"Cannot get contents of {file_path}"
 
     return {
-        # functools.cache to implicitly memoize all function calls
-        f.__name__: functools.cache(f)
+        # Bounded cache to implicitly memoize all function calls; the file listing and
+        # anything reading file contents invalidate on mtime instead so edits show up
+        f.__name__: (
+            f
+            if f in (list_files_in_repository, find_string_in_file, get_file_source)
+            else cached()(f)
+        )
         for f in [
             list_files_in_repository,
             find_string_in_file,
             find_string_in_repository,
+            find_strings_in_repository,
             request_document_symbols,
             request_repository_symbols,
             request_references,
@@ -156,21 +589,169 @@ def compute_tools_for_context(
     }
 
 
+def specialize_tool(f: typing.Callable) -> typing.Callable[[dict], typing.Any]:
+    """Builds a caller for a tool that takes the model's argument dict and passes it on
+    positionally, with the parameter order worked out once up front. For cached() tools
+    the arguments are normalized here and passed straight to the lru_cache, skipping the
+    wrapper's signature binding. Argument dicts that don't match the signature exactly
+    go through ** so they fail the way they always have."""
+    parameters = tuple(inspect.signature(f).parameters)
+    parameter_names = frozenset(parameters)
+    cached_function = getattr(f, "cached_function", None)
+
+    def call_with_arguments(arguments: dict):
+        if arguments.keys() != parameter_names:
+            return f(**arguments)
+        if cached_function is not None:
+            arguments = _normalize_tool_arguments(arguments)
+            return cached_function(*[arguments[parameter] for parameter in parameters])
+        return f(*[arguments[parameter] for parameter in parameters])
+
+    return call_with_arguments
+
+
+def summarize_repository_files(files: list[str]) -> str:
+    """Collapses a file listing into its top-level entries with file counts, in a stable
+    order so the prompt prefix stays byte-identical between calls."""
+    directories = collections.Counter()
+    top_level_files = []
+    for file in files:
+        head, separator, _ = file.partition(os.sep)
+        if separator:
+            directories[head] += 1
+        else:
+            top_level_files.append(head)
+
+    return "\n".join(
+        sorted(
+            [f"{name}{os.sep} ({count} files)" for name, count in directories.items()]
+            + top_level_files
+        )
+    )
+
+
+def _serialize_truncated_text(text: str) -> str:
+    """Encodes a string for the transcript, cutting it short (with a note saying so) if
+    the encoding would go over MAX_TOOL_RESULT_BYTES."""
+    payload = orjson.dumps(text)
+    length = len(text)
+    while len(payload) > MAX_TOOL_RESULT_BYTES:
+        # Escaping and multi-byte characters make the encoded size only roughly
+        # proportional to the length, so shrink and re-check
+        length = min(length - 1, length * MAX_TOOL_RESULT_BYTES // len(payload))
+        payload = orjson.dumps(
+            f"{text[:length]}\n[truncated: {length} of {len(text)} characters shown]"
+        )
+
+    return payload.decode()
+
+
+def serialize_tool_result(tool_return_value) -> str:
+    """Encodes a tool's return value for the chat transcript, keeping it under
+    MAX_TOOL_RESULT_BYTES: long result lists are cut to MAX_TOOL_RESULT_ITEMS, and ones
+    still too large are summarized by their first and last few results."""
+    if isinstance(tool_return_value, str):
+        return _serialize_truncated_text(tool_return_value)
+
+    if not isinstance(tool_return_value, (list, tuple)):
+        payload = orjson.dumps(tool_return_value)
+        if len(payload) > MAX_TOOL_RESULT_BYTES:
+            return _serialize_truncated_text(payload.decode())
+        return payload.decode()
+
+    result_count = len(tool_return_value)
+    items = tool_return_value[:MAX_TOOL_RESULT_ITEMS]
+    payload = orjson.dumps(items)
+    if len(payload) <= MAX_TOOL_RESULT_BYTES:
+        if result_count > MAX_TOOL_RESULT_ITEMS:
+            payload = orjson.dumps(
+                {"result_count": result_count, "first_results": items}
+            )
+        return payload.decode()
+
+    # The preview slices mustn't overlap, or short lists get every item sent twice
+    preview = TRUNCATED_TOOL_RESULT_PREVIEW_ITEMS
+    first_results = list(tool_return_value[:preview])
+    last_results = list(tool_return_value[max(preview, result_count - preview) :])
+    while True:
+        payload = orjson.dumps(
+            {
+                "result_count": result_count,
+                "first_results": first_results,
+                "last_results": last_results,
+            }
+        )
+        if len(payload) <= MAX_TOOL_RESULT_BYTES or not (
+            first_results or last_results
+        ):
+            break
+        # Give up results from the middle of the list first
+        if len(last_results) >= len(first_results):
+            last_results.pop(0)
+        else:
+            first_results.pop()
+
+    return payload.decode()
+
+
+MODEL_NAME = "llama3.2:latest"
+
+# One HTTP connection pool for every chat round, and one language server per
+# repository; the server takes seconds to start so it's kept up between queries.
+OLLAMA = AsyncClient()
+
+_lsp_cache: dict[str, SyncLanguageServer] = {}
+_lsp_cache_lock = threading.Lock()
+_lsp_servers = contextlib.ExitStack()
+
+
+def get_language_server(localpath: pathlib.Path) -> SyncLanguageServer:
+    """Returns the running language server for a repository, starting it on first use.
+    It stays up until stop_language_servers() is called."""
+    with _lsp_cache_lock:
+        if str(localpath) not in _lsp_cache:
+            config = MultilspyConfig.from_dict({"code_language": "python"})
+            logger = MultilspyLogger()
+            lsp = SyncLanguageServer.create(config, logger, str(localpath))
+            _lsp_servers.enter_context(lsp.start_server())
+            _lsp_cache[str(localpath)] = lsp
+
+        return _lsp_cache[str(localpath)]
+
+
+def stop_language_servers():
+    with _lsp_cache_lock:
+        _lsp_servers.close()
+        _lsp_cache.clear()
+
+
 # Interesting part
-def query_repo_for_information(prompt: str, path: str = "."):
+async def stream_chat_chunks(
+    prompt: str, path: str = ".", response_format: dict | None = None
+) -> typing.AsyncIterator[ChatResponse]:
+    """Has the model answer a prompt, calling tools as it sees fit, and yields its
+    replies chunk by chunk as they stream in. The last chunk of each turn has `done`
+    set."""
     localpath = pathlib.Path(path).absolute()
 
-    config = MultilspyConfig.from_dict({"code_language": "python"})
-    logger = MultilspyLogger()
-    lsp = SyncLanguageServer.create(config, logger, str(localpath))
-    with lsp.start_server():
-        tool_dict = compute_tools_for_context(localpath, lsp)
+    # Starting the language server, opening the symbol cache and walking the repository
+    # all block, so keep them off the event loop other requests are being served from
+    lsp = await asyncio.to_thread(get_language_server, localpath)
+    symbol_cache = await asyncio.to_thread(open_symbol_cache, localpath)
+    with contextlib.closing(symbol_cache):
+        skipped_files = collections.Counter()
+        tool_dict = await asyncio.to_thread(
+            compute_tools_for_context, localpath, lsp, symbol_cache, skipped_files
+        )
+        repository_summary = await asyncio.to_thread(
+            lambda: summarize_repository_files(tool_dict["list_files_in_repository"]())
+        )
 
         messages = [
             {"role": "system", "content": PROMPT},
             {
                 "role": "assistant",
-                "content": f"Here are the names of all the files in the project:\n```\n{'\n'.join(tool_dict['list_files_in_repository']())}\n```",
+                "content": f"Here are the top-level entries in the project:\n```\n{repository_summary}\n```",
             },
             {
                 "role": "user",
@@ -178,38 +759,118 @@ def query_repo_for_information(prompt: str, path: str = "."):
             },
         ]
 
+        specialized_tools = {
+            name: specialize_tool(tool) for name, tool in tool_dict.items()
+        }
+
+        # Tool calls from one turn are independent, so run them side by side
+        tool_calls_in_flight = asyncio.Semaphore(8)
+
+        async def call_tool(tool):
+            async with tool_calls_in_flight:
+                return await asyncio.to_thread(
+                    specialized_tools[tool.function.name], tool.function.arguments
+                )
+
+        # A repeated call's result is already in the transcript; re-sending it only
+        # costs the model more prompt to chew through.
+        seen_tool_calls = set()
+
         made_tool_calls_in_this_loop = True
+        model_wants_tool_calls = True
 
         loops = 0
 
-        while made_tool_calls_in_this_loop and loops < 10:
-            response = Client().chat(
-                model="llama3.2:latest",
+        while (
+            made_tool_calls_in_this_loop
+            and loops < 10
+            and sum(len(message["content"]) for message in messages)
+            < MAX_TRANSCRIPT_CHARACTERS
+        ):
+            model_wants_tool_calls = False
+            tool_calls = []
+            # Tool calls come through in their own chunk, so streaming every turn
+            # costs nothing and gets the final answer's first tokens out sooner
+            async for chunk in await OLLAMA.chat(
+                model=MODEL_NAME,
                 tools=tool_dict.values(),
                 messages=messages,
+                stream=True,
+            ):
+                for tool in chunk.message.tool_calls or []:
+                    model_wants_tool_calls = True
+                    key = (
+                        tool.function.name,
+                        orjson.dumps(
+                            tool.function.arguments, option=orjson.OPT_SORT_KEYS
+                        ),
+                    )
+                    if key not in seen_tool_calls:
+                        seen_tool_calls.add(key)
+                        tool_calls.append(tool)
+                yield chunk
+            made_tool_calls_in_this_loop = bool(tool_calls)
+
+            tool_return_values = await asyncio.gather(
+                *(call_tool(tool) for tool in tool_calls), return_exceptions=True
             )
-            made_tool_calls_in_this_loop = False
 
-            for tool in response.message.tool_calls or []:
-                try:
-                    tool_func = tool_dict.get(tool.function.name)
-                    tool_return_value = tool_func(**tool.function.arguments)
+            # gather() keeps the order the model asked in, so the transcript is stable
+            for tool, tool_return_value in zip(tool_calls, tool_return_values):
+                if isinstance(tool_return_value, BaseException):
                     print(
-                        f"Tool call: {tool.function.name}({tool.function.arguments}) -> {tool_return_value}"
+                        f"Tool call: {tool.function.name}({tool.function.arguments}) failed: {tool_return_value}"
                     )
-                    messages.append(
-                        {"role": "tool", "content": json.dumps(tool_return_value)}
-                    )
-                except Exception as e:
-                    print(
-                        f"Tool call: {tool.function.name}({tool.function.arguments}) failed: {e}"
-                    )
-                    pass
-                made_tool_calls_in_this_loop = True
+                    continue
+
+                print(
+                    f"Tool call: {tool.function.name}({tool.function.arguments}) -> {tool_return_value}"
+                )
+                messages.append(
+                    {
+                        "role": "tool",
+                        "content": serialize_tool_result(tool_return_value),
+                    }
+                )
 
             loops += 1
 
-        return response.message.content
+        # A response format constrains the whole generation, which would leave the
+        # model no way to call tools; so it only applies to a last, tool-free turn.
+        if model_wants_tool_calls or response_format is not None:
+            # Either we ran out of turns (or the model only repeated itself) before it
+            # got around to answering, or the answer has to come back in a set format;
+            # have it answer with what it has, no more tools.
+            async for chunk in await OLLAMA.chat(
+                model=MODEL_NAME,
+                messages=messages,
+                format=response_format,
+                stream=True,
+            ):
+                yield chunk
+
+        _report_skipped_files(skipped_files)
+
+
+async def stream_repo_answer(prompt: str, path: str = ".") -> typing.AsyncIterator[str]:
+    """Yields the text of the model's replies to a prompt as it is generated."""
+    async for chunk in stream_chat_chunks(prompt, path):
+        if chunk.message.content:
+            yield chunk.message.content
+
+
+async def query_repo_for_information(
+    prompt: str, path: str = ".", response_format: dict | None = None
+) -> str:
+    """Returns the model's final answer to a prompt, once it's done."""
+    answer = ""
+    turn_content = []
+    async for chunk in stream_chat_chunks(prompt, path, response_format):
+        turn_content.append(chunk.message.content or "")
+        if chunk.done:
+            answer, turn_content = "".join(turn_content), []
+
+    return answer
 
 
 class RepositoryQuery(pydantic.BaseModel):
@@ -220,28 +881,99 @@ class RepositoryAnswer(pydantic.BaseModel):
     response: str
 
 
-app = fastapi.FastAPI()
+class RepositoryBatchAnswer(pydantic.BaseModel):
+    responses: list[str]
+
+
+async def query_repo_for_batch(questions: list[str], path: str = ".") -> list[str]:
+    """Answers several questions in one conversation so the system prompt and
+    repository summary are only processed once per MAX_BATCH_SIZE questions."""
+
+    async def answer_batch(batch: list[str]) -> list[str]:
+        numbered_questions = "\n".join(
+            f"{number}) {question}" for number, question in enumerate(batch, 1)
+        )
+        content = await query_repo_for_information(
+            "Answer each question independently, giving one response per question "
+            f"in the same order:\n{numbered_questions}",
+            path=path,
+            response_format=RepositoryBatchAnswer.model_json_schema(),
+        )
+        try:
+            responses = RepositoryBatchAnswer.model_validate_json(content).responses
+        except pydantic.ValidationError:
+            # A malformed or truncated reply shouldn't sink every question in the batch
+            print("Batch answer didn't match its schema, asking one at a time")
+            responses = await asyncio.gather(
+                *(query_repo_for_information(question, path=path) for question in batch)
+            )
+        # Don't let a model that skipped or merged answers shift the rest around
+        return (responses + [""] * len(batch))[: len(batch)]
+
+    batches = await asyncio.gather(
+        *(
+            answer_batch(questions[start : start + MAX_BATCH_SIZE])
+            for start in range(0, len(questions), MAX_BATCH_SIZE)
+        )
+    )
+    return list(itertools.chain.from_iterable(batches))
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: fastapi.FastAPI):
+    # Warm up the language server before the first request comes in
+    await asyncio.to_thread(
+        get_language_server, pathlib.Path("./sample-project").absolute()
+    )
+    yield
+    stop_language_servers()
+
+
+app = fastapi.FastAPI(lifespan=lifespan)
 
 
 @app.post("/query")
-def query_repo(request: RepositoryQuery) -> RepositoryAnswer:
+async def query_repo(request: RepositoryQuery) -> RepositoryAnswer:
     return RepositoryAnswer(
-        response=query_repo_for_information(
+        response=await query_repo_for_information(
             prompt=request.question, path="./sample-project"
         )
     )
 
 
+@app.post("/query/stream")
+async def query_repo_stream(request: RepositoryQuery) -> StreamingResponse:
+    return StreamingResponse(
+        stream_repo_answer(prompt=request.question, path="./sample-project"),
+        media_type="text/plain",
+    )
+
+
+@app.post("/query_batch")
+async def query_repo_batch(requests: list[RepositoryQuery]) -> list[RepositoryAnswer]:
+    return [
+        RepositoryAnswer(response=response)
+        for response in await query_repo_for_batch(
+            [request.question for request in requests], path="./sample-project"
+        )
+    ]
+
+
 if __name__ == "__main__":
 
     @click.command()
     @click.argument("query")
     def main(query):
-        return_value = query_repo_for_information(
-            query,
-            path="./sample-project",
-        )
+        async def print_answer():
+            prefix = " -> "
+            async for text in stream_repo_answer(query, path="./sample-project"):
+                print(prefix + text, end="", flush=True)
+                prefix = ""
+            print()
 
-        print(" -> ", return_value)
+        try:
+            asyncio.run(print_answer())
+        finally:
+            stop_language_servers()
 
     main()
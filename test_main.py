@@ -0,0 +1,123 @@
+import pathlib
+import tempfile
+import unittest
+
+import orjson
+
+import main
+
+
+class EmptyFileLanguageServer:
+    """Behaves like multilspy talking to jedi-language-server, which returns None for
+    documentSymbol on a file without symbols and so trips an assertion in multilspy."""
+
+    def __init__(self, root: pathlib.Path):
+        self.root = root
+
+    def request_document_symbols(self, file_path):
+        if not (self.root / file_path).read_text():
+            raise AssertionError()
+        return [{"name": "f", "kind": 12}], None
+
+
+class RequestSymbolsTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = pathlib.Path(directory.name)
+        (self.root / "__init__.py").write_text("")
+        (self.root / "module.py").write_text("def f():\n    pass\n")
+
+        self.symbol_cache = main.open_symbol_cache(self.root)
+        self.addCleanup(self.symbol_cache.close)
+        self.tools = main.compute_tools_for_context(
+            self.root, EmptyFileLanguageServer(self.root), self.symbol_cache
+        )
+
+    def test_empty_file_has_no_symbols(self):
+        self.assertEqual(self.tools["request_document_symbols"]("__init__.py"), [])
+
+    def test_empty_file_symbols_are_not_cached(self):
+        self.tools["request_document_symbols"]("__init__.py")
+        rows = self.symbol_cache.execute(
+            "SELECT path FROM symbols WHERE path = ?", ("__init__.py",)
+        ).fetchall()
+        self.assertEqual(rows, [])
+
+    def test_empty_file_does_not_fail_repository_symbols(self):
+        self.assertEqual(
+            self.tools["request_repository_symbols"](),
+            [{"name": "f", "kind": 12, "file_path": "module.py"}],
+        )
+
+
+class SearchColumnTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        root = pathlib.Path(directory.name)
+        # "İ" lowercases to two characters, shifting the lowered text
+        (root / "a.py").write_text("İfoo föo\n")
+
+        symbol_cache = main.open_symbol_cache(root)
+        self.addCleanup(symbol_cache.close)
+        self.tools = main.compute_tools_for_context(root, None, symbol_cache)
+
+    def test_find_string_in_file_columns(self):
+        self.assertEqual(
+            self.tools["find_string_in_file"]("a.py", "foo"),
+            [{"file_path": "a.py", "row": 1, "column": 2}],
+        )
+        self.assertEqual(
+            self.tools["find_string_in_file"]("a.py", "FÖO"),
+            [{"file_path": "a.py", "row": 1, "column": 6}],
+        )
+
+    def test_find_strings_in_repository_columns(self):
+        locations = self.tools["find_strings_in_repository"](["foo", "föo"])
+        self.assertEqual(
+            [(found["string_pattern"], found["column"]) for found in locations],
+            [("foo", 2), ("föo", 6)],
+        )
+
+
+class SerializeToolResultTest(unittest.TestCase):
+    def test_preview_of_short_list_does_not_repeat_results(self):
+        results = [{"file_path": f"{n}.py", "padding": "x" * 10_000} for n in range(5)]
+        summary = orjson.loads(main.serialize_tool_result(results))
+
+        self.assertEqual(summary["result_count"], 5)
+        shown = summary["first_results"] + summary["last_results"]
+        self.assertEqual(len(shown), len({result["file_path"] for result in shown}))
+
+    def test_large_list_fits_in_byte_budget(self):
+        results = [{"file_path": f"{n}.py", "padding": "x" * 10_000} for n in range(5)]
+        payload = main.serialize_tool_result(results)
+
+        self.assertLessEqual(len(payload.encode()), main.MAX_TOOL_RESULT_BYTES)
+        self.assertEqual(orjson.loads(payload)["result_count"], 5)
+
+    def test_large_string_is_truncated(self):
+        payload = main.serialize_tool_result("line\n" * 20_000)
+
+        self.assertLessEqual(len(payload.encode()), main.MAX_TOOL_RESULT_BYTES)
+        self.assertIn("[truncated:", orjson.loads(payload))
+
+
+class SpecializeToolTest(unittest.TestCase):
+    def test_cached_tool_shares_cache_with_wrapper(self):
+        calls = []
+
+        @main.cached()
+        def tool(file_path, string_pattern):
+            calls.append((file_path, string_pattern))
+            return len(calls)
+
+        specialized = main.specialize_tool(tool)
+        self.assertEqual(specialized({"file_path": "./a.py", "string_pattern": "X"}), 1)
+        self.assertEqual(tool("a.py", "x"), 1)
+        self.assertEqual(calls, [("a.py", "x")])
+
+
+if __name__ == "__main__":
+    unittest.main()